@@ -1,9 +1,23 @@
 #!/usr/bin/env python3
 import json
-import re
+import mmap
+import os
+import stat
 import sys
+from collections import defaultdict
+from functools import lru_cache
+from hashlib import blake2b
 from pathlib import Path
-from urllib.parse import urlparse, parse_qs
+
+try:
+    from orjson import dumps as orjson_dumps, loads as json_loads
+
+    def json_dumps(obj):
+        return orjson_dumps(obj).decode()
+
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
 
 # usage: python3 trace_to_d3_elk.py trace.jsonl /path/to/output_dir
 trace_file = sys.argv[1]
@@ -12,109 +26,140 @@ img_dir = out_dir / "images"
 out_dir.mkdir(parents=True, exist_ok=True)
 img_dir.mkdir(parents=True, exist_ok=True)
 
+
 # ---------- load trace ----------
-trace = []
-with open(trace_file) as f:
-    for line in f:
-        t = json.loads(line)
-        trace.append(
-            {
-                "url": t.get("url"),
-                "prev": t.get("hash_previous"),
-                "curr": t.get("hash_current"),
-                "screenshot": t.get("screenshot"),
-                "action": t.get("action"),
-            }
-        )
+def _trace_lines(f):
+    """Yield the raw lines of an open trace file"""
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        # pipes, FIFOs and empty files can't be mapped
+        yield from f
+        return
+    # lines are read straight out of the page cache rather than through a
+    # buffered file object
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield from iter(mm.readline, b"")
+
+
+def read_trace(path):
+    """Yield the (cov_hash, url, screenshot, action) of each trace entry"""
+    with open(path, "rb") as f:
+        for line in _trace_lines(f):
+            if not line.strip():
+                continue
+            t = json_loads(line)
+            yield (
+                # coverage hash must exist for original clustering
+                t.get("hash_current") or 0,  # or whatever coverage integer
+                t.get("url"),
+                t.get("screenshot"),
+                t.get("action"),
+            )
 
 
 def split_url(url):
-    """Return path segments, query parameters dict, and fragment as a feature"""
-    parsed = urlparse(url)
-    path_segments = parsed.path.strip("/").split("/")
-    query_params = parse_qs(parsed.query)
-    fragment = parsed.fragment
+    """Return path segments, query (name, value) pairs, and fragment, undecoded"""
+    rest, _, fragment = url.partition("#")
+    rest, _, query = rest.partition("?")
+    path = rest[rest.find(":") + 1 :]  # drop the scheme, if any
+    if path.startswith("//"):
+        # drop the authority
+        slash = path.find("/", 2)
+        path = path[slash:] if slash >= 0 else ""
+    # drop ;params from the last segment, as urlparse does
+    semicolon = path.find(";", path.rfind("/") + 1)
+    if semicolon >= 0:
+        path = path[:semicolon]
+    path_segments = path.strip("/").split("/")
+    query_params = []
+    if query:
+        for param in query.split("&"):
+            name, _, value = param.partition("=")
+            if value:
+                query_params.append((name, value))
     return path_segments, query_params, fragment
 
 
-UUID_RE = re.compile(
-    r"^[0-9a-fA-F]{8}-"
-    r"[0-9a-fA-F]{4}-"
-    r"[0-9a-fA-F]{4}-"
-    r"[0-9a-fA-F]{4}-"
-    r"[0-9a-fA-F]{12}$"
-)
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+
+def is_uuid(s):
+    """Whether s is an 8-4-4-4-12 hex UUID"""
+    return (
+        len(s) == 36
+        and s[8] == s[13] == s[18] == s[23] == "-"
+        and HEX_DIGITS.issuperset(s[:8] + s[9:13] + s[14:18] + s[19:23] + s[24:])
+    )
+
+
+WEIGHTED_PARAMS = frozenset(["page", "lang"])
 
 
 def segment_weight(segment=None, param_name=None):
     """Assign weight: path=1, numeric/UUID=0.5, query params important=0.5, else 0"""
     if param_name:
-        return 0.5 if param_name in ["page", "lang"] else 0
+        return 0.5 if param_name in WEIGHTED_PARAMS else 0
     if segment is None:
         return 1
-    if segment.isdigit() or UUID_RE.match(segment):
+    if segment.isdigit() or is_uuid(segment):
         return 0.5
     return 1
 
 
 def feature_hash(s):
-    """Simple 64-bit hash"""
-    h = 0xCBF29CE484222325
-    fnv_prime = 0x100000001B3
-    for c in s:
-        h ^= ord(c)
-        h *= fnv_prime
-        h &= 0xFFFFFFFFFFFFFFFF
-    return h
+    """64-bit hash (BLAKE2b)"""
+    digest = blake2b(s.encode("utf-8", "surrogatepass"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
 
 
 def url_features(url):
-    parsed = urlparse(url)
-    path_segments = parsed.path.strip("/").split("/")
-    query_params = parse_qs(parsed.query)
-    fragment = parsed.fragment
+    """Return (feature, weight) pairs; a feature counts weight times in the simhash"""
+    path_segments, query_params, fragment = split_url(url)
     features = []
     # path
     segment_count = len(path_segments)
     for i, seg in enumerate(path_segments):
         if seg:
             w = int(segment_weight(seg) * (((i + 1) / segment_count + 0.5) ** 2)) or 1
-            features.extend([seg] * w)
+            features.append((seg, w))
     # query
-    for k, vals in query_params.items():
+    for k, v in query_params:
         w = segment_weight(None, k)
         if w > 0:
-            for v in vals:
-                features.extend([f"{k}={v}"] * int(w * 10))
+            features.append((f"{k}={v}", int(w * 10)))
     # fragment
     if fragment:
-        features.extend([fragment] * 5)  # moderate weight
+        features.append((fragment, 5))  # moderate weight
     return features
 
 
+LANE_BITS = 32
+LANE_DIGITS = LANE_BITS // 4  # hex digits per lane
+LANE_ONES = int("1".rjust(LANE_DIGITS, "0") * 64, 16)  # 1 in every lane
+LANE_TOPS = LANE_ONES << (LANE_BITS - 1)  # top bit of every lane
+
+
+@lru_cache(maxsize=None)
+def feature_lanes(s):
+    """Feature hash with bit i moved to lane i, so that sums count every bit"""
+    padding = "0" * (LANE_DIGITS - 1)
+    return int(padding.join(f"{feature_hash(s):064b}"), 16)
+
+
+@lru_cache(maxsize=None)
 def url_simhash(url):
     feats = url_features(url)
-    v = [0] * 64
-    for f in feats:
-        h = feature_hash(f)
-        for i in range(64):
-            v[i] += 1 if (h >> i) & 1 else -1
-    sim = 0
-    for i, val in enumerate(v):
-        if val > 0:
-            sim |= 1 << i
-    return sim
-
-
-# ---------- compute simhashes for trace ----------
-for t in trace:
-    # coverage hash must exist for original clustering
-    t["cov_hash"] = t.get("curr") or 0  # or whatever coverage integer
-    url = t.get("url")
-    if url:
-        t["url_simhash"] = url_simhash(url)
-    else:
-        t["url_simhash"] = 0
+    ones = sum(w * feature_lanes(f) for f, w in feats)
+    total = sum(w for _, w in feats)
+    # bit i is set when more features have it set than not, i.e. when lane i
+    # holds at least total // 2 + 1; biasing every lane by that much below its
+    # top bit turns the comparison into a mask
+    bias = (1 << (LANE_BITS - 1)) - (total // 2 + 1)
+    votes = ((ones + bias * LANE_ONES) & LANE_TOPS) >> (LANE_BITS - 1)
+    # every lane is now 0 or 1, held by its last hex digit
+    digits = f"{votes:0{64 * LANE_DIGITS}x}"
+    return int(digits[LANE_DIGITS - 1 :: LANE_DIGITS], 2)
+
 
 # ---------- weighted clustering ----------
 coverage_weight = 1.0
@@ -122,58 +167,82 @@ url_weight = 2.0
 THRESHOLD = 8  # adjust as needed
 
 
-def combined_distance(a, b):
-    """Weighted sum of coverage Hamming and URL simhash Hamming"""
-    d_cov = bin(a["cov_hash"] ^ b["cov_hash"]).count("1")
-    d_url = bin(a.get("url_simhash", 0) ^ b.get("url_simhash", 0)).count("1")
-    total_weight = coverage_weight + url_weight
-    return (coverage_weight * d_cov + url_weight * d_url) / total_weight
-
-
-clusters = []
-node_to_cluster = {}
-
-for idx, t in enumerate(trace):
-    for ci, cluster in enumerate(clusters):
-        rep_idx = cluster[0]
-        rep = trace[rep_idx]
-        if combined_distance(t, rep) <= THRESHOLD:
-            cluster.append(idx)
-            node_to_cluster[idx] = ci
-            break
-    else:
-        # new cluster
-        clusters.append([idx])
-        node_to_cluster[idx] = len(clusters) - 1
-
+# LSH banding: URL simhashes are split into bands and a new state is only
+# compared with clusters whose representative shares at least one band
+BANDS = 8
+BAND_BITS = 64 // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def assign_clusters(entries):
+    """Return (cluster, screenshot, action) per entry, and the number of clusters"""
+    cov_w, url_w = coverage_weight, url_weight
+    # THRESHOLD applied to the weighted sum, saving the division per candidate
+    limit = THRESHOLD * (cov_w + url_w)
+    band_shifts = range(0, 64, BAND_BITS)
+    band_mask = BAND_MASK
+    # (cov_hash, url_simhash) of each cluster's representative
+    reps = []
+    # (band shift, band value) -> clusters whose representative has that band value
+    band_index = defaultdict(list)
+    # revisited states always land in the cluster they were first assigned to,
+    # so only the first visit needs to look for a matching representative
+    state_to_cluster = {}
+    records = []
+    get_cluster = state_to_cluster.get
+    add_record = records.append
+    for cov_hash, url, screenshot, action in entries:
+        # missing URLs have no features and hash to 0
+        url_sh = url_simhash(url or "")
+        key = (cov_hash, url_sh)
+        ci = get_cluster(key)
+        if ci is None:
+            bands = [(shift, (url_sh >> shift) & band_mask) for shift in band_shifts]
+            for c in sorted({c for band in bands for c in band_index.get(band, ())}):
+                rep_cov, rep_url = reps[c]
+                d_cov = (cov_hash ^ rep_cov).bit_count()
+                d_url = (url_sh ^ rep_url).bit_count()
+                if cov_w * d_cov + url_w * d_url <= limit:
+                    ci = c
+                    break
+            else:
+                # new cluster
+                ci = len(reps)
+                reps.append(key)
+                for band in bands:
+                    band_index[band].append(ci)
+            state_to_cluster[key] = ci
+        add_record((ci, screenshot, action))
+    return records, len(reps)
+
+
+# cluster, screenshot and action of each trace entry, clustered as it is read
+records, cluster_count = assign_clusters(read_trace(trace_file))
+if not records:
+    sys.exit(f"no trace entries in {trace_file}")
+node_to_cluster, screenshots, actions = zip(*records)
 
 first_cluster = node_to_cluster[0]
 
 cluster_images = {}
 cluster_all_images = {}
 
-for ci, cluster in enumerate(clusters):
-    # representative image = first non-empty screenshot
-    cluster_images[ci] = next(
-        (
-            trace[idx].get("screenshot")
-            for idx in cluster
-            if trace[idx].get("screenshot")
-        ),
-        None,
-    )
+for ci, screenshot in zip(node_to_cluster, screenshots):
+    if not screenshot:
+        continue
     # all images in cluster
-    cluster_all_images[ci] = [
-        trace[idx].get("screenshot") for idx in cluster if trace[idx].get("screenshot")
-    ]
+    images = cluster_all_images.setdefault(ci, [])
+    # representative image = first non-empty screenshot
+    if not images:
+        cluster_images[ci] = screenshot
+    images.append(screenshot)
 
 
 # ---------- summarize actions ----------
 def summarize_action(action):
     if not action:
         return "?"
-    variant = next(iter(action.keys()))
-    data = action[variant]
+    variant, data = next(iter(action.items()))
     if variant == "Click":
         name = data.get("name", "?")
         content = data.get("content")
@@ -186,36 +255,20 @@ def summarize_action(action):
 
 
 # ---------- edges ----------
-edges = []
-seen = set()
-last_idx = None  # last trace index
-
-for idx, t in enumerate(trace):
-    curr_idx = idx
-    prev_idx = last_idx
-
-    if prev_idx is None:
-        last_idx = curr_idx
-        continue
-
-    ci = node_to_cluster[prev_idx]
-    cj = node_to_cluster[curr_idx]
-    label = summarize_action(t.get("action"))
-
-    # key to deduplicate edges between clusters with the same label
-    key = (ci, cj, label)
-    if key not in seen:
-        edges.append(
-            {
-                "id": f"e{ci}_{cj}_{len(edges)}",
-                "sources": [str(ci)],
-                "targets": [str(cj)],
-                "label": label,
-            }
-        )
-        seen.add(key)
-
-    last_idx = curr_idx
+# one (source cluster, target cluster, label) transition per step of the trace,
+# deduplicated in order of first occurrence
+transitions = dict.fromkeys(
+    zip(node_to_cluster, node_to_cluster[1:], map(summarize_action, actions[1:]))
+)
+edges = [
+    {
+        "id": f"e{ci}_{cj}_{n}",
+        "sources": [str(ci)],
+        "targets": [str(cj)],
+        "label": label,
+    }
+    for n, (ci, cj, label) in enumerate(transitions)
+]
 
 # ---------- ELK graph ----------
 elk_graph = {
@@ -234,7 +287,7 @@ elk_graph = {
             "id": str(ci),
             "width": 160,
             "height": 120,
-            "label": f"{'START ' if ci==first_cluster else ''}({len(cluster_all_images[ci])})",
+            "label": f"{'START ' if ci==first_cluster else ''}({len(cluster_all_images.get(ci, []))})",
             "image": cluster_images.get(ci),
             "screenshots": cluster_all_images.get(ci, []),
             "layoutOptions": (
@@ -245,7 +298,7 @@ elk_graph = {
                 else {}
             ),
         }
-        for ci, _ in enumerate(clusters)
+        for ci in range(cluster_count)
     ],
     "edges": edges,
 }
@@ -341,7 +394,7 @@ svg {{
 </div>
 
 <script>
-const elkGraph = {json.dumps(elk_graph)};
+const elkGraph = {json_dumps(elk_graph)};
 const elk = new ELK();
 const svg = d3.select("svg");
 const g = svg.select("g");
@@ -34,6 +34,7 @@
             buildInputs = with pkgs; [
               graphviz
               python3
+              python3Packages.orjson
               python3Packages.pillow
             ];
           };